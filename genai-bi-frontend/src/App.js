@@ -530,33 +530,56 @@ function App() {
     setError('');
     setPendingQuery(query); // Mark that a query is pending
 
-    try {
-      const backendUrl = 'http://127.0.0.1:8000/get-insight';
-      const response = await fetch(backendUrl, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ query: query }),
+    const question = query;
+    const entryIdx = history.length;
+    const timestamp = new Date().toISOString();
+    // Create or update this question's history entry; shown as soon as the first stage arrives
+    const updateEntry = (getFields) => {
+      setHistory(prev => {
+        const entry = prev[entryIdx] || { question, sql: '', data: [], narrative: '', bullets: [], chartType: 'table', error: null, timestamp };
+        const next = prev.slice();
+        next[entryIdx] = { ...entry, ...getFields(entry) };
+        return next;
       });
+      setSelectedIdx(entryIdx);
+      setPendingQuery(null);
+      setIsHome(false);
+    };
 
-      if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-      const data = await response.json();
-
-      setHistory(prev => [
-        ...prev,
-        {
-          question: query,
-          sql: data.sql,
-          data: data.data,
-          narrative: data.narrative,
-          bullets: data.bullets,
-          chartType: data.chartType,
-          error: data.error,
-          timestamp: new Date().toISOString(),
-        }
-      ]);
-      setSelectedIdx(history.length);
+    try {
+      // Stream the stages so the SQL and rows render before the narrative is finished
+      const backendUrl = `http://127.0.0.1:8000/get-insight-stream?query=${encodeURIComponent(question)}`;
+      await new Promise((resolve, reject) => {
+        const source = new EventSource(backendUrl);
+        source.onmessage = (e) => {
+          const event = JSON.parse(e.data);
+          if (event.stage === 'sql') {
+            updateEntry(() => ({ sql: event.sql }));
+          } else if (event.stage === 'rows') {
+            updateEntry(entry => ({ data: [...entry.data, ...event.data] }));
+          } else if (event.stage === 'narrative') {
+            updateEntry(() => ({ narrative: event.summary, bullets: event.bullets }));
+          } else if (event.stage === 'done') {
+            const data = event.response;
+            // Streamed responses leave the rows out of 'done'; they already came as 'rows' events
+            updateEntry(entry => ({
+              sql: data.sql,
+              data: data.data || entry.data,
+              narrative: data.narrative,
+              bullets: data.bullets,
+              chartType: data.chartType,
+              error: data.error,
+            }));
+            source.close();
+            resolve();
+          }
+        };
+        source.onerror = () => {
+          source.close();
+          reject(new Error('Stream connection failed'));
+        };
+      });
       setQuery('');
-      setIsHome(false); // Ensure home is false after submit
     } catch (err) {
       setError('Failed to get a response from the backend. Please ensure it is running and accessible.');
     } finally {
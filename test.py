@@ -1,33 +1,102 @@
 import os
-import sqlite3
+import re
+import logging
+import asyncio
+import time
+import secrets
 import yaml
-import ast
-import json
-from typing import List
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    # PyYAML built without libyaml.
+    from yaml import SafeLoader, SafeDumper
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, List, Literal
+import numpy as np
+import orjson
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import sqlalchemy
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.globals import set_llm_cache
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
-from langchain.agents import create_react_agent, AgentExecutor
-from langchain_community.tools.sql_database.tool import ListSQLDatabaseTool, InfoSQLDatabaseTool
 from langchain_core.tools import BaseTool
-from langchain_community.utilities import SQLDatabase
-from sqlalchemy import create_engine, inspect
+from langchain_core.runnables import RunnableLambda
+from sqlalchemy import create_engine, event, inspect
 import uvicorn
 
 # --- config.py content ---
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-2.5-flash")
+# Cheaper, faster variant for trivial sub-tasks such as intent classification.
+LLM_LIGHT_MODEL = os.getenv("LLM_LIGHT_MODEL", "gemini-2.5-flash-lite")
+# Let the LLM settle chart types the rule-based recommendation can't decide on.
+USE_AI_CHART_RECOMMENDATION = os.getenv("USE_AI_CHART_RECOMMENDATION", "false").lower() == "true"
+# Per-request tracing (intent, cache hits, agent steps) is only emitted in debug mode.
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# Only the app's own logger goes to DEBUG; library loggers (httpx, grpc, sqlalchemy) stay at INFO.
+if DEBUG:
+    logger.setLevel(logging.DEBUG)
+# Each worker is a separate process with its own in-memory response caches; the SQLite
+# LLM cache file is the store they share.
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+# Admin endpoints (/reload-schema) are disabled unless a token is configured.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 # --- db.py content ---
 DB_FILE = "olist.db"
 SCHEMA_FILE = "db_schema.yaml"
-db_engine = create_engine(f"sqlite:///{DB_FILE}")
-db = SQLDatabase(engine=db_engine)
+# A bounded burst above pool_size; pre-ping is skipped since a local SQLite file can't drop the link.
+db_engine = create_engine(
+    f"sqlite:///{DB_FILE}", connect_args={"check_same_thread": False}, pool_size=8, max_overflow=5, pool_pre_ping=False
+)
+
+@event.listens_for(db_engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # Applied to every pooled connection, so the page cache stays warm across requests.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # Memory-map up to 256 MB of the file so hot pages are read without a syscall each.
+    cursor.execute("PRAGMA mmap_size=268435456")
+    # Set last: the journal mode switch above writes to the file. Nothing in the app writes
+    # through this engine, so any write the query checks miss is refused by SQLite itself.
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+# Generated queries can match millions of rows; rows are read in chunks and reading stops at the cap.
+MAX_RESULT_ROWS = 10000
+RESULT_CHUNK_ROWS = 1000
+
+def run_query(engine, sql, max_rows=None):
+    """Execute once and return the column names, the raw row tuples and whether max_rows cut them off."""
+    with engine.connect() as connection:
+        result_proxy = connection.execution_options(stream_results=True, yield_per=RESULT_CHUNK_ROWS).execute(sqlalchemy.text(sql))
+        columns = list(result_proxy.keys())
+        rows = []
+        for partition in result_proxy.partitions():
+            rows.extend(partition)
+            if max_rows is not None and len(rows) > max_rows:
+                break
+    truncated = max_rows is not None and len(rows) > max_rows
+    return {"columns": columns, "rows": rows[:max_rows] if truncated else rows, "truncated": truncated}
+
+def rows_to_columns(columns, rows):
+    return {name: list(values) for name, values in zip(columns, zip(*rows))}
+
+def columns_to_records(result_columns):
+    names = list(result_columns)
+    return [dict(zip(names, values)) for values in zip(*result_columns.values())]
 
 def get_full_schema(engine):
     inspector = inspect(engine)
@@ -59,29 +128,93 @@ def get_full_schema(engine):
     return schema
 
 def load_or_create_schema():
+    """Return the schema and its YAML text, which is what the prompts embed."""
     if os.path.exists(SCHEMA_FILE):
-        print(f"Loading schema from existing file: {SCHEMA_FILE}")
+        logger.info("Loading schema from existing file: %s", SCHEMA_FILE)
         with open(SCHEMA_FILE, 'r') as f:
-            return yaml.safe_load(f)
+            schema_text = f.read()
+        return yaml.load(schema_text, Loader=SafeLoader), schema_text
     else:
-        print("Schema file not found. Generating new schema from database...")
+        logger.info("Schema file not found. Generating new schema from database...")
         schema_data = get_full_schema(db_engine)
+        schema_text = yaml.dump(schema_data, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
         with open(SCHEMA_FILE, 'w') as f:
-            yaml.dump(schema_data, f, default_flow_style=False, sort_keys=False)
-        print(f"New schema saved to {SCHEMA_FILE}. You can now edit this file to add descriptions.")
-        return schema_data
+            f.write(schema_text)
+        logger.info("New schema saved to %s. You can now edit this file to add descriptions.", SCHEMA_FILE)
+        return schema_data, schema_text
+
+# The file text is used as-is rather than re-dumped, so prompts see exactly what was edited.
+DB_SCHEMA, DB_SCHEMA_STRING = load_or_create_schema()
 
-DB_SCHEMA = load_or_create_schema()
-DB_SCHEMA_STRING = yaml.dump(DB_SCHEMA, default_flow_style=False, sort_keys=False)
+def build_schema_structured(schema):
+    """Tables, columns, keys and the relationships between tables, in the shape the frontend renders."""
+    tables = []
+    relationships = []
+    for t in schema.get("tables", []):
+        foreign_keys = []
+        for fk in t.get("foreign_keys", []):
+            # Composite keys pair up column by column.
+            for column, ref_column in zip(fk["constrained_columns"], fk["referred_columns"]):
+                foreign_keys.append({"column": column, "ref_table": fk["referred_table"], "ref_column": ref_column})
+                relationships.append({
+                    "from_table": t["name"], "from_column": column,
+                    "to_table": fk["referred_table"], "to_column": ref_column
+                })
+        tables.append({
+            "name": t["name"],
+            "description": t.get("description", ""),
+            "columns": [
+                {"name": col["name"], "type": col["type"], "description": col.get("description", "")}
+                for col in t["columns"]
+            ],
+            "primary_key": t.get("primary_key", []),
+            "foreign_keys": foreign_keys
+        })
+    return {"tables": tables, "relationships": relationships}
+
+# Derived straight from the schema, so the structure endpoint needs no LLM call.
+SCHEMA_STRUCTURED = build_schema_structured(DB_SCHEMA)
 
 # --- utils.py content ---
 CURRENCY_KEYWORDS = [
     "amount", "price", "cost", "revenue", "total", "spent", "sales", "income", "payment", "charge", "fee", "balance"
 ]
 CURRENCY_SYMBOL = "$"
+CURRENCY_FORMAT = CURRENCY_SYMBOL + "{:,}"
+# One C-level scan per column name instead of a Python substring test per keyword.
+CURRENCY_RE = re.compile("|".join(re.escape(word) for word in CURRENCY_KEYWORDS), re.IGNORECASE)
 
 def is_currency_column(col_name):
-    return any(word in col_name.lower() for word in CURRENCY_KEYWORDS)
+    return bool(CURRENCY_RE.search(col_name))
+
+# Opening/closing markdown fences around generated SQL, in a single pass.
+SQL_FENCE_RE = re.compile(r"^\s*```(?:sqlite|sql)?\s*|\s*```\s*$", re.IGNORECASE | re.MULTILINE)
+
+def strip_sql_fences(text):
+    return SQL_FENCE_RE.sub("", text).strip()
+
+def json_default(value):
+    # orjson has no Decimal support; anything else unknown falls back to str, like json.dumps(default=str).
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+def to_json(value):
+    """orjson-backed json.dumps for the per-request payloads (result rows, SSE events)."""
+    return orjson.dumps(value, default=json_default).decode()
+
+class AppJSONResponse(ORJSONResponse):
+    # Handlers return this directly: a plain dict would first go through FastAPI's
+    # jsonable_encoder, which walks every result row before orjson ever sees it.
+    def render(self, content):
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+# First table after FROM, optionally double-quoted; enough to look up column types.
+SQL_FROM_TABLE_RE = re.compile(r'\bfrom\s+"?([A-Za-z_]\w*)"?', re.IGNORECASE)
+
+def get_query_table(sql):
+    match = SQL_FROM_TABLE_RE.search(sql)
+    return match.group(1) if match else None
 
 def format_currency(val):
     try:
@@ -89,44 +222,205 @@ def format_currency(val):
     except Exception:
         return val
 
-def format_result_data(result_data):
-    if not result_data:
-        return result_data
-    formatted = []
-    for row in result_data:
-        new_row = {}
-        for k, v in row.items():
-            if is_currency_column(k) and isinstance(v, (int, float)):
-                new_row[k] = format_currency(v)
-            else:
-                new_row[k] = v
-        formatted.append(new_row)
+def format_currency_column(values):
+    """format_currency for a whole column; all-numeric columns are rounded in one NumPy call."""
+    if set(map(type, values)) <= {int, float}:
+        numbers = np.asarray(values, dtype=np.float64)
+        # Also rejects NaN/inf and anything that would overflow int64.
+        if (np.abs(numbers) < 2.0 ** 63).all():
+            return list(map(CURRENCY_FORMAT.format, np.rint(numbers).astype(np.int64).tolist()))
+    # Mixed columns (NULLs, text, Decimals) keep the per-value path.
+    return [format_currency(v) if isinstance(v, (int, float)) else v for v in values]
+
+def format_result_columns(result_columns, table=None):
+    """Format currency columns in a column-oriented result; other columns are left untouched."""
+    # Whether a column holds currency depends only on its name, so decide it once per column.
+    formatted = dict(result_columns)
+    for k, values in result_columns.items():
+        if is_currency_column_smart(k, table):
+            formatted[k] = format_currency_column(values)
     return formatted
 
+def build_column_type_index(schema):
+    return {
+        (t["name"].lower(), col["name"].lower()): col["type"].lower()
+        for t in schema.get("tables", [])
+        for col in t["columns"]
+    }
+
+COLUMN_TYPE_INDEX = build_column_type_index(DB_SCHEMA)
+
 def get_column_type(table, column):
-    tables = DB_SCHEMA.get("tables", [])
-    for t in tables:
-        if t["name"] == table:
-            for col in t["columns"]:
-                if col["name"].lower() == column.lower():
-                    return col["type"].lower()
-    return ""
+    return COLUMN_TYPE_INDEX.get((table.lower(), column.lower()), "")
+
+# With a known numeric column type, a narrower keyword set is enough to call it currency.
+CURRENCY_SMART_KEYWORDS = ["amount", "price", "cost", "revenue", "payment", "charge", "fee", "balance"]
+CURRENCY_SMART_RE = re.compile("|".join(re.escape(word) for word in CURRENCY_SMART_KEYWORDS), re.IGNORECASE)
 
+# Result column names repeat across requests, so the verdict is memoised per (column, table).
+@lru_cache(maxsize=4096)
 def is_currency_column_smart(col_name, table=None):
     if table:
         col_type = get_column_type(table, col_name)
-        if col_type in ("real", "numeric", "decimal", "money", "float") and any(word in col_name.lower() for word in ["amount", "price", "cost", "revenue", "payment", "charge", "fee", "balance"]):
+        if col_type in ("real", "numeric", "decimal", "money", "float") and CURRENCY_SMART_RE.search(col_name):
             return True
         return False
-    return any(word in col_name.lower() for word in CURRENCY_KEYWORDS)
+    return is_currency_column(col_name)
+
+NUMERIC_COLUMN_TYPES = ("int", "bigint", "real", "numeric", "decimal", "money", "float", "double")
+
+def is_numeric_column(values, col_name, table=None):
+    if table and get_column_type(table, col_name).startswith(NUMERIC_COLUMN_TYPES):
+        return True
+    values = [v for v in values if v is not None]
+    return bool(values) and all(isinstance(v, (int, float)) for v in values)
+
+def get_chart_recommendation(result_columns, table=None):
+    columns = list(result_columns)
+    row_count = len(result_columns[columns[0]]) if columns else 0
+    if row_count == 1 and len(columns) == 1 and is_numeric_column(result_columns[columns[0]], columns[0], table):
+        return "kpi"
+    if row_count > 1 and len(columns) > 1 and is_numeric_column(result_columns[columns[1]], columns[1], table):
+        return "bar"
+    return "table"
+
+def describe_result_columns(result_columns, table=None):
+    """Name and type of each result column, from the schema or else the first non-null value."""
+    described = []
+    for name, values in result_columns.items():
+        col_type = get_column_type(table, name) if table else ""
+        if not col_type:
+            sample = next((v for v in values if v is not None), None)
+            col_type = type(sample).__name__ if sample is not None else "null"
+        described.append({"name": name, "type": col_type})
+    return described
+
+def is_chart_type_disputed(chart_type, result_data):
+    return chart_type == "table" and len(result_data) > 1
+
+class SemanticCache:
+    """Nearest-neighbour lookup over L2-normalised question embeddings.
+
+    Holds at most ``maxsize`` entries, evicting expired ones first and then the least
+    recently used; with a ``ttl`` (seconds) older entries stop matching.
+    """
+
+    def __init__(self, threshold, maxsize=1024, ttl=None):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clear()
+
+    def clear(self):
+        self.embeddings = None
+        self.created = np.empty(0)
+        self.last_used = np.empty(0)
+        self.entries = []
+
+    def lookup(self, embedding):
+        if not self.entries:
+            return None
+        similarities = self.embeddings @ embedding
+        now = time.monotonic()
+        if self.ttl is not None:
+            similarities = np.where(now - self.created < self.ttl, similarities, -1.0)
+        idx = int(np.argmax(similarities))
+        if similarities[idx] >= self.threshold:
+            self.last_used[idx] = now
+            return self.entries[idx]
+        return None
+
+    def add(self, embedding, value):
+        now = time.monotonic()
+        if len(self.entries) >= self.maxsize:
+            # Overwrite the least recently used row in place rather than reshaping the matrix;
+            # expired rows go first, however recently they were used.
+            last_used = self.last_used
+            if self.ttl is not None:
+                last_used = np.where(now - self.created >= self.ttl, -np.inf, last_used)
+            idx = int(np.argmin(last_used))
+            self.embeddings[idx] = embedding
+            self.created[idx] = now
+            self.last_used[idx] = now
+            self.entries[idx] = value
+            return
+        row = embedding[np.newaxis, :]
+        self.embeddings = row if self.embeddings is None else np.vstack([self.embeddings, row])
+        self.created = np.append(self.created, now)
+        self.last_used = np.append(self.last_used, now)
+        self.entries.append(value)
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+def normalize_embedding(vector):
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(arr)
+    return arr / norm if norm else arr
 
 # --- chains.py content ---
-llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", google_api_key=GOOGLE_API_KEY, temperature=0)
+LLM_CACHE_FILE = ".langchain_cache.db"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+CACHE_MAXSIZE = 1024
+CACHE_TTL_SECONDS = 3600
+# Data-query responses carry their result rows, so only small results are cached: both query
+# caches then hold at most CACHE_MAXSIZE * CACHE_MAX_ROWS rows however large results get.
+CACHE_MAX_ROWS = 1000
+# gRPC keeps one HTTP/2 channel per client and multiplexes concurrent calls over it;
+# the memoized getters below make sure every request shares that channel.
+LLM_TRANSPORT = "grpc"
+LLM_TIMEOUT_SECONDS = 30
+
+# The Gemini client, langchain_community and the agent stack are imported on first use
+# rather than at module load, so a worker binds its port quickly and only pays for
+# what it serves. Each getter is memoized, so everything is still built once per process.
+@lru_cache(maxsize=1)
+def configure_llm_cache():
+    from langchain_community.cache import SQLiteCache
+    # Exact-match prompt cache that survives restarts and is shared by every worker.
+    set_llm_cache(SQLiteCache(database_path=LLM_CACHE_FILE))
+
+@lru_cache(maxsize=None)
+def get_llm(model):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    configure_llm_cache()
+    return ChatGoogleGenerativeAI(
+        model=model, google_api_key=GOOGLE_API_KEY, temperature=0,
+        transport=LLM_TRANSPORT, timeout=LLM_TIMEOUT_SECONDS
+    )
+
+@lru_cache(maxsize=1)
+def get_embeddings():
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    return GoogleGenerativeAIEmbeddings(
+        model="models/text-embedding-004", google_api_key=GOOGLE_API_KEY,
+        transport=LLM_TRANSPORT, request_options={"timeout": LLM_TIMEOUT_SECONDS}
+    )
+
+async def embed_question(question):
+    try:
+        # The pinned client ignores request_options, so bound the call here as well.
+        return normalize_embedding(await asyncio.wait_for(get_embeddings().aembed_query(question), LLM_TIMEOUT_SECONDS))
+    except Exception:
+        # The semantic caches are an optimisation; never fail a request over them.
+        return None
+
+def lazy_embedding(question):
+    """Async getter that embeds the question on its first call and reuses the result after that."""
+    task = None
+    async def get_embedding():
+        nonlocal task
+        if task is None:
+            task = asyncio.create_task(embed_question(question))
+        return await task
+    return get_embedding
 
 class Intent(BaseModel):
-    intent: str = Field(description="Classify the user's intent. 'data_query' for data requests. 'descriptive_question' for schema questions. 'destructive_request' for any request to modify, delete, or drop data.")
+    intent: Literal["data_query", "descriptive_question", "destructive_request"] = Field(description="Classify the user's intent. 'data_query' for data requests. 'descriptive_question' for schema questions. 'destructive_request' for any request to modify, delete, or drop data.")
 
 parser = JsonOutputParser(pydantic_object=Intent)
+# Format instructions embed the model's JSON schema; generate them once at import.
+INTENT_FORMAT_INSTRUCTIONS = parser.get_format_instructions()
 classification_prompt_template = """As a security-focused AI, you must first classify the user's intent.
 The user wants to interact with a database. Your primary goal is to identify if their request is a safe data query, a simple descriptive question, or a potentially harmful destructive request.
 A 'destructive_request' is ANY request that asks to add, delete, modify, or remove data, tables, or database structure. This includes words like 'delete', 'remove', 'drop', 'insert', 'update', 'add', etc.
@@ -136,31 +430,102 @@ Based on the user's question, classify the intent into one of three categories:
 Question: {question}
 Format Instructions: {format_instructions}
 """
-classification_prompt = PromptTemplate(
-    template=classification_prompt_template,
-    input_variables=["question"],
-    partial_variables={"format_instructions": parser.get_format_instructions()},
+def fast_prompt(template, **partials):
+    """str.format-based prompt for the per-request chains, without PromptTemplate's
+    validation and partial merging. Callable partials are read at format time."""
+    def format_prompt(inputs):
+        values = {k: v() if callable(v) else v for k, v in partials.items()}
+        return template.format(**values, **inputs)
+    return RunnableLambda(format_prompt)
+
+classification_prompt = fast_prompt(classification_prompt_template, format_instructions=INTENT_FORMAT_INSTRUCTIONS)
+
+@lru_cache(maxsize=1)
+def get_classification_chain():
+    return classification_prompt | get_llm(LLM_LIGHT_MODEL) | parser
+
+INTENT_CACHE = SemanticCache(SEMANTIC_CACHE_THRESHOLD, maxsize=CACHE_MAXSIZE)
+INTENT_EXACT_CACHE = LRUCache(maxsize=4 * CACHE_MAXSIZE)
+# Imperative write commands are destructive whatever follows; anchored so that
+# "which customers update their address" still goes to the classifier.
+DESTRUCTIVE_COMMAND_RE = re.compile(
+    r"^\s*(please\s+)?(drop|delete|truncate|insert|update|alter|grant|revoke|remove)\b", re.IGNORECASE
 )
-classification_chain = classification_prompt | llm | parser
+
+async def embed_and_classify(question):
+    """Return (get_embedding, intent), overlapping the embedding and classifier calls.
+
+    get_embedding comes from lazy_embedding, so the regex and exact-cache fast paths never pay
+    for an embedding call unless a later stage actually reads it.
+    """
+    get_embedding = lazy_embedding(question)
+    if DESTRUCTIVE_COMMAND_RE.match(question):
+        return get_embedding, "destructive_request"
+    key = normalize_question(question)
+    cached_intent = INTENT_EXACT_CACHE.get(key)
+    if cached_intent is not None:
+        return get_embedding, cached_intent
+    # The classifier is started alongside the embedding and only cancelled if the
+    # embedding turns out to be a semantic cache hit, so a miss costs max() not sum().
+    classify_task = asyncio.create_task(get_classification_chain().ainvoke({"question": question}))
+    question_embedding = await get_embedding()
+    if question_embedding is not None:
+        cached_intent = INTENT_CACHE.lookup(question_embedding)
+        if cached_intent is not None:
+            classify_task.cancel()
+            return get_embedding, cached_intent
+    intent_result = await classify_task
+    intent = intent_result.get("intent")
+    INTENT_EXACT_CACHE[key] = intent
+    if question_embedding is not None:
+        INTENT_CACHE.add(question_embedding, intent)
+    return get_embedding, intent
 
 FORBIDDEN_KEYWORDS = ["DROP", "DELETE", "UPDATE", "INSERT", "GRANT", "REVOKE", "ALTER", "TRUNCATE", "CREATE"]
+# Word boundaries catch ";DROP" or "DROP\tTABLE" while leaving identifiers such as "insert_ts" alone.
+FORBIDDEN_RE = re.compile(r"\b(" + "|".join(FORBIDDEN_KEYWORDS) + r")\b", re.IGNORECASE)
+# String literals and comments, so the structural checks only look at real SQL tokens.
+SQL_LITERAL_OR_COMMENT_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?(?:\*/|\Z)", re.DOTALL)
+READ_ONLY_STATEMENT_RE = re.compile(r"\s*(select|with)\b", re.IGNORECASE)
+
+def sql_skeleton(sql):
+    """Blank out literals and comments; what remains is keywords, identifiers and punctuation."""
+    return SQL_LITERAL_OR_COMMENT_RE.sub(lambda m: "''" if m.group(0)[0] in "'\"" else " ", sql)
+
 class SafeQuerySQLDataBaseTool(BaseTool):
     name: str = "sql_db_query_checker"
     description: str = "Input to this tool is a SQL query, output is a result from the database. Use this to query the database for information."
-    db: SQLDatabase
-    def _run(self, query: str) -> str:
+    engine: sqlalchemy.engine.Engine
+    def _check_query(self, query: str) -> str:
         # Clean the query of markdown/code block markers
-        clean_query = query.strip().replace("```sqlite", "").replace("```", "").strip()
-        upper_query = clean_query.upper()
-        for keyword in FORBIDDEN_KEYWORDS:
-            if f" {keyword} " in f" {upper_query} " or upper_query.startswith(keyword + " "):
-                return f"Error: The query was blocked because it contained the forbidden keyword '{keyword}'."
-        result = self.db.run(clean_query)
-        return str(result)
-
-safe_sql_tool = SafeQuerySQLDataBaseTool(db=db)
-list_tables_tool = ListSQLDatabaseTool(db=db)
-info_sql_tool = InfoSQLDatabaseTool(db=db)
+        clean_query = strip_sql_fences(query)
+        # Keywords inside literals or comments ("LIKE '%update%'") are data, not statements.
+        skeleton = sql_skeleton(clean_query)
+        match = FORBIDDEN_RE.search(skeleton)
+        if match:
+            raise ValueError(f"The query was blocked because it contained the forbidden keyword '{match.group(1).upper()}'.")
+        statements = [stmt for stmt in skeleton.split(";") if stmt.strip()]
+        if not statements:
+            raise ValueError("The query was blocked because it was empty.")
+        if len(statements) > 1:
+            raise ValueError("The query was blocked because it contained more than one statement.")
+        if not READ_ONLY_STATEMENT_RE.match(statements[0]):
+            raise ValueError("The query was blocked because only SELECT queries are allowed.")
+        return clean_query
+
+    def _run(self, query: str) -> str:
+        try:
+            clean_query = self._check_query(query)
+        except ValueError as e:
+            return f"Error: {e}"
+        result = run_query(self.engine, clean_query, max_rows=MAX_RESULT_ROWS)
+        return str([tuple(row) for row in result["rows"]])
+
+    def fetch(self, query: str) -> dict:
+        """Run a checked query and return native rows instead of the agent-facing string."""
+        return run_query(self.engine, self._check_query(query), max_rows=MAX_RESULT_ROWS)
+
+safe_sql_tool = SafeQuerySQLDataBaseTool(engine=db_engine)
 
 sql_generation_template = """You are an expert data analyst. Your sole purpose is to write a single, syntactically correct SQL query to answer the user's question.
 Base your query ONLY on the provided database schema. Pay close attention to the column and table descriptions, primary keys, and foreign keys for creating joins. Since you have information about the schema, you can use it to create complex queries that involve multiple tables and conditions.
@@ -176,14 +541,49 @@ User Question:
 SQL Query (must be a correct SQL query):
 ```sqlite
 """
-sql_generation_prompt = PromptTemplate(
-    template=sql_generation_template,
-    input_variables=["question"],
-    partial_variables={"schema": DB_SCHEMA_STRING}
-)
-generate_query_chain = sql_generation_prompt | llm | StrOutputParser()
 
-agent_tools = [safe_sql_tool, list_tables_tool, info_sql_tool]
+# Only the tables most relevant to a question are sent to the SQL prompt, which keeps
+# prompt tokens flat as the schema grows.
+SCHEMA_RETRIEVAL_TOP_K = 4
+# (tables, embeddings) pair, so a schema reload can never pair new tables with old vectors.
+schema_table_embeddings = None
+
+def describe_table_for_retrieval(table):
+    col_str = ", ".join(col["name"] for col in table["columns"])
+    return f"Table {table['name']}: {table.get('description', '')} Columns: {col_str}"
+
+async def select_relevant_tables(question_embedding):
+    global schema_table_embeddings
+    tables = DB_SCHEMA.get("tables", [])
+    if question_embedding is None or len(tables) <= SCHEMA_RETRIEVAL_TOP_K:
+        return None
+    snapshot = schema_table_embeddings
+    try:
+        if snapshot is None or snapshot[0] is not tables:
+            vectors = await asyncio.wait_for(
+                get_embeddings().aembed_documents([describe_table_for_retrieval(t) for t in tables]), LLM_TIMEOUT_SECONDS
+            )
+            snapshot = (tables, np.vstack([normalize_embedding(v) for v in vectors]))
+            schema_table_embeddings = snapshot
+    except Exception:
+        return None
+    tables, table_embeddings = snapshot
+    similarities = table_embeddings @ question_embedding
+    selected = {tables[i]["name"] for i in np.argsort(-similarities)[:SCHEMA_RETRIEVAL_TOP_K]}
+    # Keep the tables the selection joins to, otherwise the model can't write the join.
+    for t in tables:
+        if t["name"] in selected:
+            selected.update(fk["referred_table"] for fk in t.get("foreign_keys", []))
+    return frozenset(selected)
+
+@lru_cache(maxsize=32)
+def get_sql_generation_chain(table_names=None):
+    schema = lambda: DB_SCHEMA_STRING
+    if table_names is not None:
+        schema_subset = {"tables": [t for t in DB_SCHEMA.get("tables", []) if t["name"] in table_names]}
+        schema = yaml.dump(schema_subset, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
+    return fast_prompt(sql_generation_template, schema=schema) | get_llm(LLM_MODEL) | StrOutputParser()
+
 react_template = """You are an agent designed to interact with a SQL database. Given an input question, use the available tools to answer. Only use the given tools. You also have access to the Database Schema. Use that to return any description and show how one table relates to the other if applicable. Do not make up any information.
 
 Database Schema:
@@ -214,112 +614,128 @@ Thought:{agent_scratchpad}
 agent_prompt = PromptTemplate(
     template=react_template,
     input_variables=["input", "agent_scratchpad", "tools", "tool_names"],
-    partial_variables={"schema": DB_SCHEMA_STRING}
+    partial_variables={"schema": lambda: DB_SCHEMA_STRING}
 )
-agent = create_react_agent(llm, agent_tools, agent_prompt)
-agent_executor = AgentExecutor(agent=agent, tools=agent_tools, verbose=True, handle_parsing_errors=True)
-
-class InsightOutput(BaseModel):
-    summary: str
-    bullets: List[str] = []
-insight_parser = JsonOutputParser(pydantic_object=InsightOutput)
-narrative_prompt = PromptTemplate(
-    template=(
-        "Given the user's question: '{question}' and the following data: '{result}', "
-        "write a brief summary insight (1-2 sentences) as 'summary', and if there are any key findings, "
-        "list them as bullet points in a 'bullets' array. "
-        "Respond in JSON with keys 'summary' and 'bullets'."
-    ),
-    input_variables=["question", "result"]
+
+@lru_cache(maxsize=1)
+def get_sql_database():
+    from langchain_community.utilities import SQLDatabase
+    return SQLDatabase(engine=db_engine)
+
+@lru_cache(maxsize=1)
+def get_schema_tools():
+    from langchain_community.tools.sql_database.tool import ListSQLDatabaseTool, InfoSQLDatabaseTool
+    db = get_sql_database()
+    return ListSQLDatabaseTool(db=db), InfoSQLDatabaseTool(db=db)
+
+@lru_cache(maxsize=1)
+def get_agent_executor():
+    from langchain.agents import create_react_agent, AgentExecutor
+    list_tables_tool, info_sql_tool = get_schema_tools()
+    agent_tools = [safe_sql_tool, list_tables_tool, info_sql_tool]
+    agent = create_react_agent(get_llm(LLM_MODEL), agent_tools, agent_prompt)
+    return AgentExecutor(agent=agent, tools=agent_tools, verbose=DEBUG, handle_parsing_errors=True)
+
+# Descriptive questions that a single schema tool call answers skip the ReAct loop.
+# Whole-question forms only: "which tables store payments?" needs a real answer, not a name dump.
+SCHEMA_LIST_RE = re.compile(
+    r"^\s*(what|which|how\s+many)\s+tables\s+(are\s+there|exist|do\s+we\s+have)(\s+in\s+the\s+(database|db))?\s*\??\s*$",
+    re.IGNORECASE,
 )
-narrative_chain = narrative_prompt | llm | insight_parser
-
-axis_title_prompt = PromptTemplate(
-    template=(
-        "Given the user's question: '{question}', the SQL query: '{sql}', and the column names: {columns}, "
-        "suggest the best X and Y axis titles for a chart visualizing this data. "
-        "Respond in JSON as: {{'x': <x axis title>, 'y': <y axis title>}}."
-    ),
-    input_variables=["question", "sql", "columns"]
+SCHEMA_INFO_RE = re.compile(r"\b(columns?|fields?|attributes|describe|structure)\b", re.IGNORECASE)
+
+def build_table_name_re(schema):
+    if not schema.get("tables"):
+        return None
+    return re.compile(r"\b(" + "|".join(re.escape(t["name"]) for t in schema["tables"]) + r")\b", re.IGNORECASE)
+
+TABLE_NAME_RE = build_table_name_re(DB_SCHEMA)
+
+# Only show full schema if the question is generic
+GENERIC_SCHEMA_KEYWORDS = [
+    "schema", "all tables", "database structure", "show schema", "show tables", "list tables", "database diagram"
+]
+
+def route_descriptive_question(question):
+    """Return ('schema_redirect', None), ('schema_list', None), ('schema_info', table_names) or ('general', None).
+
+    Everything but 'general' is answered locally from the schema, without the agent or the caches.
+    """
+    if any(word in question.lower() for word in GENERIC_SCHEMA_KEYWORDS):
+        return "schema_redirect", None
+    if SCHEMA_LIST_RE.search(question):
+        return "schema_list", None
+    if TABLE_NAME_RE and SCHEMA_INFO_RE.search(question):
+        table_names = {m.lower() for m in TABLE_NAME_RE.findall(question)}
+        if table_names:
+            return "schema_info", sorted(t["name"] for t in DB_SCHEMA["tables"] if t["name"].lower() in table_names)
+    return "general", None
+
+def describe_tables(table_names):
+    """Readable description and column list for each named table, plus the relationships they take part in."""
+    table_summaries = []
+    for t in SCHEMA_STRUCTURED["tables"]:
+        if t["name"] not in table_names:
+            continue
+        desc = t["description"]
+        col_str = ", ".join(f"{col['name']} ({col['type']})" for col in t["columns"])
+        table_summaries.append(
+            f"- {t['name']}: {desc if desc and desc != 'Enter table description here.' else 'No description.'}"
+            + (f"\n    Columns: {col_str}" if col_str else "")
+        )
+    rel_summaries = [
+        f"- {rel['from_table']}({rel['from_column']}) → {rel['to_table']}({rel['to_column']})"
+        for rel in SCHEMA_STRUCTURED["relationships"]
+        if rel["from_table"] in table_names or rel["to_table"] in table_names
+    ]
+    summary = "\n".join(table_summaries)
+    if rel_summaries:
+        summary += "\n\nRelationships:\n" + "\n".join(rel_summaries)
+    return summary
+
+CHART_TYPES = {"kpi", "bar", "pie", "table"}
+
+class CombinedInsight(BaseModel):
+    summary: str = Field(description="A brief summary insight (1-2 sentences) answering the question.")
+    bullets: List[str] = Field(default=[], description="Key findings as bullet points, if there are any.")
+    chart_type: Literal["kpi", "bar", "pie", "table"] = Field(description="The best chart type to visualize the answer.")
+    axis_titles: Dict[str, str] = Field(description="The best X and Y axis titles for the chart, with keys 'x' and 'y'.")
+combined_parser = JsonOutputParser(pydantic_object=CombinedInsight)
+COMBINED_FORMAT_INSTRUCTIONS = combined_parser.get_format_instructions()
+# One round trip for everything that is derived from the query result, instead of
+# separate narrative, axis-title and chart-type calls that each resend the data.
+# Only the result's own columns and types are sent, not the whole schema. Instructions come
+# first and the per-request values last, so calls share an identical prefix.
+combined_template = (
+    "Given the user's question, the SQL query, the result columns and the data below, "
+    "write a brief summary insight (1-2 sentences) as 'summary', and if there are any key findings, "
+    "list them as bullet points in a 'bullets' array. "
+    "Recommend the best chart type to visualize the answer as 'chart_type', choosing one from: 'kpi', 'bar', 'pie', 'table'. "
+    "Suggest the best X and Y axis titles for that chart as 'axis_titles'.\n"
+    "{format_instructions}\n\n"
+    "User's question: '{question}'\n"
+    "SQL query: '{sql}'\n"
+    "Columns (name and type): {columns}\n"
+    "Data: '{result}'"
 )
-axis_title_parser = JsonOutputParser()
-def get_axis_titles_llm(question, sql, columns):
-    prompt = axis_title_prompt.format(
-        question=question,
-        sql=sql,
-        columns=json.dumps(columns)
-    )
-    try:
-        result_str = llm.invoke(prompt)
-        result = axis_title_parser.invoke(result_str)
-        if isinstance(result, dict) and "x" in result and "y" in result:
-            return result
-    except Exception:
-        pass
+combined_prompt = fast_prompt(combined_template, format_instructions=COMBINED_FORMAT_INSTRUCTIONS)
+
+@lru_cache(maxsize=1)
+def get_combined_chain():
+    return combined_prompt | get_llm(LLM_MODEL) | combined_parser
+
+def default_axis_titles(columns):
     return {"x": columns[0] if columns else "X", "y": columns[1] if len(columns) > 1 else "Y"}
 
-visualization_prompt = PromptTemplate(
-    template=(
-        "Given the user's question: '{question}', the following data: '{result}', and the database schema: '{schema}', "
-        "recommend the best chart type to visualize the answer. "
-        "Choose one from: 'kpi', 'bar', 'pie', 'table'. "
-        "Respond ONLY with the chart type."
-    ),
-    input_variables=["question", "result", "schema"]
-)
-def get_ai_chart_recommendation(question, result_data, schema):
-    prompt = visualization_prompt.format(
-        question=question,
-        result=json.dumps(result_data),
-        schema=json.dumps(schema)
-    )
-    ai_response = llm.invoke(prompt)
-    if hasattr(ai_response, "content"):
-        content = ai_response.content
-        if isinstance(content, list):
-            content_str = " ".join(str(item) for item in content)
-        else:
-            content_str = str(content)
-        chart_type = content_str.strip().lower()
-    else:
-        chart_type = str(ai_response).strip().lower()
-    if chart_type not in {"kpi", "bar", "pie", "table"}:
-        chart_type = "table"
-    return chart_type
-
-schema_description_template = """
-You are a database documentation assistant. Given the following database schema in YAML, return a JSON object with:
-- "tables": a list of tables, each with:
-    - "name": table name
-    - "description": table description
-    - "columns": list of columns, each with:
-        - "name": column name
-        - "type": column type
-        - "description": column description
-    - "primary_key": list of primary key columns
-    - "foreign_keys": list of foreign keys, each with:
-        - "column": local column
-        - "ref_table": referenced table
-        - "ref_column": referenced column
-- "relationships": a list of relationships, each with:
-    - "from_table": referencing table
-    - "from_column": referencing column
-    - "to_table": referenced table
-    - "to_column": referenced column
-
-Schema:
-```yaml
-{schema}
-```
-Respond ONLY with a JSON object as described above.
-"""
-schema_description_prompt = PromptTemplate(
-    template=schema_description_template,
-    input_variables=[],
-    partial_variables={"schema": DB_SCHEMA_STRING}
-)
-schema_description_parser = JsonOutputParser()
-schema_description_chain = schema_description_prompt | llm | schema_description_parser
+def get_insight_axis_titles(insight, columns):
+    axis_titles = insight.get("axis_titles")
+    if isinstance(axis_titles, dict) and "x" in axis_titles and "y" in axis_titles:
+        return axis_titles
+    return default_axis_titles(columns)
+
+def get_insight_chart_type(insight):
+    chart_type = str(insight.get("chart_type", "")).strip().lower()
+    return chart_type if chart_type in CHART_TYPES else "table"
 
 # --- api.py content ---
 router = APIRouter()
@@ -327,52 +743,163 @@ router = APIRouter()
 class QueryRequest(BaseModel):
     query: str
 
-DESCRIPTIVE_CACHE = {}
-QUERY_CACHE = {}
+# Bounded and expiring, so popularity drift can't grow memory forever or serve stale answers.
+DESCRIPTIVE_CACHE = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL_SECONDS)
+DESCRIPTIVE_SEMANTIC_CACHE = SemanticCache(SEMANTIC_CACHE_THRESHOLD, maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL_SECONDS)
+QUERY_CACHE = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL_SECONDS)
+# Rewordings of an answered data question ("show me total payment by type" / "what is the total
+# payment by type?") reuse its response instead of re-running SQL generation and the insight call. Kept separate from the
+# descriptive cache so the two intents can never serve each other's answers.
+QUERY_SEMANTIC_CACHE = SemanticCache(SEMANTIC_CACHE_THRESHOLD, maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL_SECONDS)
+# "top 10 sellers" / "bottom 10 sellers", "revenue in 2017" / "revenue in 2018" or "shipped to
+# Sao Paulo" / "shipped to Rio" embed almost identically but need different SQL, so a semantic
+# hit must also use exactly the same content words. Only filler words are ignored; numbers,
+# quoted values, direction/superlative words and negations all have to match.
+QUESTION_TOKEN_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\w+")
+QUESTION_STOPWORDS = frozenset(
+    "a an the of for in on at by to from and is are was were be been do does did what which who how "
+    "show me list give get find tell display please i we our us my you can could would will should "
+    "that this these those there it its as have has had".split()
+)
+
+def question_terms(question):
+    question = re.sub(r"n't\b", " not", normalize_question(question))
+    return frozenset(t for t in QUESTION_TOKEN_RE.findall(question) if t not in QUESTION_STOPWORDS)
+
+async def get_cached_query(question, get_embedding):
+    cached = QUERY_CACHE.get(normalize_question(question))
+    question_embedding = await get_embedding() if cached is None else None
+    if question_embedding is not None:
+        entry = QUERY_SEMANTIC_CACHE.lookup(question_embedding)
+        if entry is not None and entry["terms"] == question_terms(question):
+            cached = entry["response"]
+    # The hit may come from a differently worded question.
+    return {**cached, "query": question} if cached is not None else None
+
+def cache_query(question, question_embedding, response):
+    if response.get("truncated") or len(response.get("data", [])) > CACHE_MAX_ROWS:
+        return
+    QUERY_CACHE[normalize_question(question)] = response
+    if question_embedding is not None:
+        QUERY_SEMANTIC_CACHE.add(question_embedding, {"terms": question_terms(question), "response": response})
+
+async def get_cached_description(question, get_embedding):
+    cached = DESCRIPTIVE_CACHE.get(normalize_question(question))
+    question_embedding = await get_embedding() if cached is None else None
+    if question_embedding is not None:
+        cached = DESCRIPTIVE_SEMANTIC_CACHE.lookup(question_embedding)
+    return cached
+
+def cache_description(question, question_embedding, entry):
+    DESCRIPTIVE_CACHE[normalize_question(question)] = entry
+    if question_embedding is not None:
+        DESCRIPTIVE_SEMANTIC_CACHE.add(question_embedding, entry)
 
 
 @router.get("/get-schema-structure")
 def get_schema_structure():
-    schema_structured = schema_description_chain.invoke({})
-    return schema_structured
+    return AppJSONResponse(SCHEMA_STRUCTURED)
+
+def build_schema_state():
+    schema, schema_string = load_or_create_schema()
+    return schema, schema_string, build_schema_structured(schema), build_column_type_index(schema), build_table_name_re(schema)
+
+@router.post("/reload-schema")
+async def reload_schema(x_admin_token: str = Header(default="")):
+    """Re-read the schema file (e.g. after editing descriptions) and rebuild everything derived from it."""
+    global DB_SCHEMA, DB_SCHEMA_STRING, SCHEMA_STRUCTURED, COLUMN_TYPE_INDEX, TABLE_NAME_RE, schema_table_embeddings
+    if not ADMIN_TOKEN or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Schema reload is not allowed.")
+    state = await asyncio.to_thread(build_schema_state)
+    # Swapped on the event loop with no await in between, so no request sees a half-reloaded schema.
+    DB_SCHEMA, DB_SCHEMA_STRING, SCHEMA_STRUCTURED, COLUMN_TYPE_INDEX, TABLE_NAME_RE = state
+    schema_table_embeddings = None
+    get_sql_generation_chain.cache_clear()
+    is_currency_column_smart.cache_clear()
+    # Cached answers were produced against the old schema.
+    DESCRIPTIVE_CACHE.clear()
+    DESCRIPTIVE_SEMANTIC_CACHE.clear()
+    QUERY_CACHE.clear()
+    QUERY_SEMANTIC_CACHE.clear()
+    return AppJSONResponse({"tables": len(DB_SCHEMA.get("tables", []))})
 
 @router.get("/get-table-sample/{table_name}")
 def get_table_sample(table_name: str):
-    with db._engine.connect() as connection:
-        try:
-            result_proxy = connection.execute(sqlalchemy.text(f'SELECT * FROM "{table_name}" LIMIT 5'))
-            column_names = list(result_proxy.keys())
-            rows = result_proxy.fetchall()
-            sample_data = [dict(zip(column_names, row)) for row in rows]
-            return {"sampleData": sample_data}
-        except Exception as e:
-            return {"error": str(e)}
+    try:
+        sample = run_query(db_engine, f'SELECT * FROM "{table_name}" LIMIT 5')
+        sample_data = columns_to_records(rows_to_columns(sample["columns"], sample["rows"]))
+        return AppJSONResponse({"sampleData": sample_data})
+    except Exception as e:
+        return AppJSONResponse({"error": str(e)})
+
 
+def sse_event(event):
+    return f"data: {to_json(event)}\n\n"
 
 @router.post("/get-insight")
-def handle_get_insight(request: QueryRequest):
-    question = request.query
-    intent_result = classification_chain.invoke({"question": question})
-    intent = intent_result.get("intent")
-    print(f"Detected Intent: {intent}")
+async def handle_get_insight(request: QueryRequest):
+    async for event in insight_events(request.query):
+        if event["stage"] == "done":
+            return AppJSONResponse(event["response"])
+
+@router.get("/get-insight-stream")
+async def stream_insight(query: str):
+    """Server-Sent Events variant of /get-insight that emits each stage as soon as it finishes."""
+    async def event_stream():
+        async for event in insight_events(query, stream=True):
+            yield sse_event(event)
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def row_events(rows):
+    # Large results reach the client in chunks instead of one oversized SSE frame.
+    for start in range(0, len(rows), RESULT_CHUNK_ROWS):
+        yield {"stage": "rows", "data": rows[start:start + RESULT_CHUNK_ROWS]}
+
+def streamed_response(response):
+    """The 'done' payload for SSE: rows were already sent as 'rows' events, so only their count is kept."""
+    summary = {k: v for k, v in response.items() if k != "data"}
+    summary["rowCount"] = len(response.get("data", []))
+    return summary
+
+async def insight_events(question, stream=False):
+    """Run the insight pipeline, yielding one event per finished stage and a final 'done' event."""
+    get_embedding, intent = await embed_and_classify(question)
+    logger.debug("Detected intent: %s", intent)
+    yield {"stage": "intent", "intent": intent}
 
-    if intent == "data_query" and question in QUERY_CACHE:
-        print(f"Returning cached result for data_query: '{question}'")
-        return QUERY_CACHE[question]
+    cached = await get_cached_query(question, get_embedding) if intent == "data_query" else None
+    if cached is not None:
+        logger.debug("Returning cached result for data_query: '%s'", question)
+        if stream:
+            for event in row_events(cached["data"]):
+                yield event
+            cached = streamed_response(cached)
+        yield {"stage": "done", "response": cached}
+        return
     
-    if intent == "descriptive_question" and question in DESCRIPTIVE_CACHE:
-        print(f"Returning cached result for descriptive_question: '{question}'")
-        cached = DESCRIPTIVE_CACHE[question]
-        return {
+    # Schema answers are computed locally and differ only by table name, which a semantic cache
+    # hit can't tell apart, so they are routed before the lookup and never cached.
+    route, route_tables = "general", None
+    if intent not in ("data_query", "destructive_request"):
+        route, route_tables = route_descriptive_question(question)
+    cached = None
+    if intent == "descriptive_question" and route == "general":
+        cached = await get_cached_description(question, get_embedding)
+    if cached is not None:
+        logger.debug("Returning cached result for descriptive_question: '%s'", question)
+        yield {"stage": "done", "response": {
             "query": question, "sql": "N/A", "data": [], "narrative": cached["narrative"],
             "bullets": cached.get("bullets", []), "chartType": "none", 
             "axisTitles": {"x": "", "y": ""}, "error": None,
             "schemaStructured": cached.get("schema_structured"),
             "agentAnswer": cached.get("agent_answer")
-        }
+        }}
+        return
 
+    question_embedding = None
     generated_sql = "N/A"
     result_data = []
+    truncated = False
     summary = ""
     bullets = []
     axis_titles = {"x": "", "y": ""}
@@ -380,57 +907,61 @@ def handle_get_insight(request: QueryRequest):
     try:
         if intent == "destructive_request":
             narrative = "Error: This request has been blocked as it was identified as potentially destructive."
-            return {"query": question, "sql": "BLOCKED", "data": [], "narrative": narrative, "chartType": "none", "error": narrative}
-        
+            yield {"stage": "done", "response": {"query": question, "sql": "BLOCKED", "data": [], "narrative": narrative, "chartType": "none", "error": narrative}}
+            return
+
         if intent == "data_query":
-            sql_with_markdown = generate_query_chain.invoke({"question": question})
-            generated_sql = sql_with_markdown.strip().replace("```sqlite", "").replace("```", "").strip()
-            # Use SQLAlchemy to execute and fetch results
-            with db._engine.connect() as connection:
-                result_proxy = connection.execute(sqlalchemy.text(generated_sql))
-                column_names = list(result_proxy.keys())
-                data_tuples = result_proxy.fetchall()
-            if data_tuples:
-                result_data = [dict(zip(column_names, row)) for row in data_tuples]
-
-                formatted = []
-                for row in result_data:
-                    new_row = {}
-                    for k, v in row.items():
-                        table = None
-                        if "from" in generated_sql.lower():
-                            after_from = generated_sql.lower().split("from")[1].split()[0]
-                            table = after_from.strip(",;")
-                        if is_currency_column_smart(k, table) and isinstance(v, (int, float)):
-                            new_row[k] = format_currency(v)
-                        else:
-                            new_row[k] = v
-                    formatted.append(new_row)
-                result_data = formatted
-
-                insight = narrative_chain.invoke({"question": question, "result": result_data})
+            question_embedding = await get_embedding()
+            table_names = await select_relevant_tables(question_embedding)
+            sql_with_markdown = await get_sql_generation_chain(table_names).ainvoke({"question": question})
+            generated_sql = strip_sql_fences(sql_with_markdown)
+            # SQLite calls block, so keep them off the event loop that serves the LLM awaits.
+            query_result = await asyncio.to_thread(safe_sql_tool.fetch, generated_sql)
+            column_names = query_result["columns"]
+            truncated = query_result["truncated"]
+            if truncated:
+                logger.info("Result truncated to the first %d rows", MAX_RESULT_ROWS)
+            if query_result["rows"]:
+                # Column-oriented, so the chart and currency passes only touch the columns they need
+                # and the row dicts are built once, at the end.
+                result_columns = rows_to_columns(column_names, query_result["rows"])
+
+                table = get_query_table(generated_sql)
+                # Decided on the raw values, before currency formatting turns numbers into strings.
+                chart_type = get_chart_recommendation(result_columns, table)
+
+                result_data = columns_to_records(format_result_columns(result_columns, table))
+                yield {"stage": "sql", "sql": generated_sql, "truncated": truncated}
+                if stream:
+                    for event in row_events(result_data):
+                        yield event
+
+                insight_input = {
+                    "question": question,
+                    "sql": generated_sql,
+                    "columns": to_json(describe_result_columns(result_columns, table)),
+                    "result": to_json(result_data),
+                }
+                if stream:
+                    insight = {}
+                    async for insight in get_combined_chain().astream(insight_input):
+                        yield {"stage": "narrative", "summary": insight.get("summary", ""), "bullets": insight.get("bullets", [])}
+                else:
+                    insight = await get_combined_chain().ainvoke(insight_input)
                 summary = insight.get("summary", "")
                 bullets = insight.get("bullets", [])
-                axis_titles = get_axis_titles_llm(question, generated_sql, column_names)
+                axis_titles = get_insight_axis_titles(insight, column_names)
+                if USE_AI_CHART_RECOMMENDATION and is_chart_type_disputed(chart_type, result_data):
+                    chart_type = get_insight_chart_type(insight)
             else:
                 summary = "The query executed successfully but returned no results."
+                chart_type = "table"
+                yield {"stage": "sql", "sql": generated_sql, "truncated": truncated}
         
         else:
-            print("Invoking agent_executor for descriptive_question...")
-            agent_result = agent_executor.invoke({"input": question})
-            agent_answer = None
-            if isinstance(agent_result, dict):
-                agent_answer = agent_result.get("output", str(agent_result))
-            else:
-                agent_answer = str(agent_result)
-
-            # Only show full schema if the question is generic
-            generic_schema_keywords = [
-                "schema", "all tables", "database structure", "show schema", "show tables", "list tables", "database diagram"
-            ]
-            if any(word in question.lower() for word in generic_schema_keywords):
+            if route == "schema_redirect":
                 narrative = "Please use the Data Exploration feature to view the database schema."
-                return {
+                yield {"stage": "done", "response": {
                     "query": question,
                     "sql": "N/A",
                     "data": [],
@@ -439,83 +970,53 @@ def handle_get_insight(request: QueryRequest):
                     "chartType": "none",
                     "axisTitles": {"x": "", "y": ""},
                     "error": None
-                }
+                }}
+                return
 
-                # Improved formatting for schema description summary
-                tables = schema_structured.get("tables", [])
-                relationships = schema_structured.get("relationships", [])
-                table_summaries = []
-                for t in tables:
-                    if isinstance(t, dict):
-                        desc = t.get("description", "")
-                        name = t.get("name", "Unknown Table")
-                        columns = t.get("columns", [])
-                        col_str = ", ".join([f"{col['name']} ({col['type']})" for col in columns]) if columns else ""
-                        table_summaries.append(
-                            f"- {name}: {desc if desc and desc != 'Enter table description here.' else 'No description.'}"
-                            + (f"\n    Columns: {col_str}" if col_str else "")
-                        )
-                rel_summaries = []
-                for rel in relationships:
-                    rel_summaries.append(
-                        f"- {rel.get('from_table')}({rel.get('from_column')}) → {rel.get('to_table')}({rel.get('to_column')})"
-                    )
-                summary = ""
-                if table_summaries:
-                    summary += "Tables in the database:\n" + "\n".join(table_summaries)
-                if rel_summaries:
-                    summary += "\n\nRelationships:\n" + "\n".join(rel_summaries)
-                if not summary:
-                    summary = "No tables or relationships found in the schema."
-                DESCRIPTIVE_CACHE[question] = {
-                    "narrative": summary,
-                    "bullets": [],
-                    "schema_structured": schema_structured,
-                    "agent_answer": agent_answer,
-                    "schema_sample_data": schema_sample_data
-                }
-                return {
-                    "query": question,
-                    "sql": "N/A",
-                    "data": [],
-                    "narrative": summary,
-                    "bullets": [],
-                    "chartType": "schema",
-                    "axisTitles": {"x": "", "y": ""},
-                    "schemaStructured": schema_structured,
-                    "agentAnswer": agent_answer,
-                    "schemaSampleData": schema_sample_data,
-                    "error": None
-                }
+            if route == "schema_list":
+                list_tables_tool, _ = get_schema_tools()
+                tables_str = await asyncio.to_thread(list_tables_tool.invoke, "")
+                agent_answer = f"The database contains the following tables: {tables_str}."
+            elif route == "schema_info":
+                agent_answer = describe_tables(route_tables)
             else:
-                # For specific descriptive questions, return only the agent's answer
-                DESCRIPTIVE_CACHE[question] = {
+                logger.debug("Invoking agent_executor for descriptive_question...")
+                agent_result = await get_agent_executor().ainvoke({"input": question})
+                agent_answer = None
+                if isinstance(agent_result, dict):
+                    agent_answer = agent_result.get("output", str(agent_result))
+                else:
+                    agent_answer = str(agent_result)
+                cache_description(question, await get_embedding(), {
                     "narrative": agent_answer,
                     "bullets": [],
                     "schema_structured": None,
                     "agent_answer": agent_answer,
                     "schema_sample_data": None
-                }
-                return {
-                    "query": question,
-                    "sql": "N/A",
-                    "data": [],
-                    "narrative": agent_answer,
-                    "bullets": [],
-                    "chartType": "none",
-                    "axisTitles": {"x": "", "y": ""},
-                    "schemaStructured": None,
-                    "agentAnswer": agent_answer,
-                    "schemaSampleData": None,
-                    "error": None
-                }
+                })
+
+            # For specific descriptive questions, return only the answer
+            yield {"stage": "done", "response": {
+                "query": question,
+                "sql": "N/A",
+                "data": [],
+                "narrative": agent_answer,
+                "bullets": [],
+                "chartType": "none",
+                "axisTitles": {"x": "", "y": ""},
+                "schemaStructured": None,
+                "agentAnswer": agent_answer,
+                "schemaSampleData": None,
+                "error": None
+            }}
+            return
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.exception("An error occurred: %s", e)
         error_message = f"An error occurred while processing your request: {str(e)}"
-        return {"query": question, "sql": generated_sql, "data": [], "narrative": error_message, "chartType": "none", "error": error_message}
+        yield {"stage": "done", "response": {"query": question, "sql": generated_sql, "data": [], "narrative": error_message, "chartType": "none", "error": error_message}}
+        return
 
-    chart_type = get_ai_chart_recommendation(question, result_data, DB_SCHEMA)
     response = {
         "query": question,
         "sql": generated_sql,
@@ -524,18 +1025,21 @@ def handle_get_insight(request: QueryRequest):
         "bullets": bullets,
         "chartType": chart_type,
         "axisTitles": axis_titles,
+        "truncated": truncated,
         "error": None
     }
 
     if intent == "data_query":
-        QUERY_CACHE[question] = response
+        cache_query(question, question_embedding, response)
 
-    return response
+    yield {"stage": "done", "response": streamed_response(response) if stream else response}
 
 # --- main.py content ---
-app = FastAPI()
+app = FastAPI(default_response_class=AppJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 app.include_router(router)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # Multiple workers need an import string so each process can load the app itself.
+    # loop/http stay on "auto", which picks uvloop and httptools when installed (not on Windows).
+    uvicorn.run("test:app" if WEB_WORKERS > 1 else app, host="127.0.0.1", port=8000, workers=WEB_WORKERS)